@@ -1,73 +1,695 @@
 """Rhasspy intent recognition with rapidfuzz"""
-import json
+import functools
+import itertools
 import logging
+import operator
+import os
 import sqlite3
+import threading
 import time
 import typing
+from collections import OrderedDict
 
 import networkx as nx
+import numpy as np
 import rapidfuzz
 import rhasspynlu
 from rhasspynlu.intent import Recognition
 
-from .train import train
+from .const import EXAMPLES_DB_VERSION, ExampleRows, Examples, IndexedPathType
+from .train import blob_to_paths, examples_to_sqlite, train, train_iter
 
 _LOGGER = logging.getLogger(__name__)
 
+PathFilterType = typing.Callable[[typing.List[int]], bool]
+MatchType = typing.Tuple[str, typing.List[int], float]
+CachedMatchType = typing.Tuple[typing.Any, typing.Optional[MatchType]]
+
+# (sentence index, example index, path)
+RankedMatchType = typing.Tuple[int, int, typing.List[int]]
+
+# (score, example index, sentence index, path)
+ScoredMatchType = typing.Tuple[float, int, int, typing.List[int]]
+
+# Open connections to examples databases (path -> (file stamp, id, connection))
+_CONNECTIONS: typing.Dict[
+    str, typing.Tuple[typing.Tuple[int, int], int, sqlite3.Connection]
+] = {}
+_CONNECTIONS_LOCK = threading.RLock()
+_CONNECTION_IDS = itertools.count()
+
+# Rows of examples databases (path -> (database version, rows))
+_EXAMPLE_ROWS: typing.Dict[
+    str, typing.Tuple[typing.Tuple[int, int], ExampleRows]
+] = {}
+
+# Length bounds are computed apart from rapidfuzz's scores and may round
+# differently, so bounds within this of the best score are still scored.
+_SCORE_TOLERANCE = 1e-6
+
+# Candidate count above which a single query is scored in parallel
+_PARALLEL_MIN_EXAMPLES = 256
+
+# Upper bound on the size of a batch score matrix (queries x sentences)
+_MAX_BATCH_SCORES = 1 << 24
+
+# Recent matches (key -> (in-memory examples, match)), including misses.
+# In-memory examples are kept alive so the id in their key can't be reused.
+_MATCH_CACHE: "OrderedDict[typing.Hashable, CachedMatchType]" = OrderedDict()
+_MATCH_CACHE_SIZE = 128
+_MATCH_CACHE_LOCK = threading.Lock()
+
+# Built-in converters, merged with extra converters once per call instead of
+# being copied and updated for every recognition
+_DEFAULT_CONVERTERS = rhasspynlu.fsticuffs.get_default_converters()
+
+# Converter values that can be shared between recognitions
+_SCALAR_TYPES = (str, int, float, type(None))
+
+# Normalized query text (the same utterances are often repeated)
+_default_process: typing.Callable[[str], str] = functools.lru_cache(maxsize=4096)(
+    rapidfuzz.utils.default_process
+)
+
 # -----------------------------------------------------------------------------
 
 
-def extract_one_sqlite(query: str, examples_path: str):
+def extract_one_sqlite(
+    query: str,
+    examples_path: str,
+    path_filter: typing.Optional[PathFilterType] = None,
+) -> typing.Optional[MatchType]:
     """Finds the best text/path for a query"""
-    conn = sqlite3.connect(examples_path)
-    c = conn.cursor()
-    c.execute("SELECT sentence FROM intents ORDER BY rowid")
+    rows = get_example_rows(examples_path)
+
+    # Check for an exact match first
+    index = rows.exact.get(query)
+    if index is not None:
+        for _, path in blob_to_paths(rows.paths[index]):
+            if (path_filter is None) or path_filter(path):
+                return (query, path, 100.0)
+
+    row_paths = rows.paths
+    best = extract_one_lengths(
+        query,
+        rows.sentences,
+        rows.lengths,
+        lambda index: blob_to_paths(row_paths[index]),
+        path_filter=path_filter,
+    )
+
+    if best is None:
+        return None
+
+    best_score, _, best_index, best_path = best
+    return (rows.sentences[best_index], best_path, best_score)
+
+
+def get_example_rows(examples_path: str) -> ExampleRows:
+    """Gets the cached rows of an examples database, reloading them if changed"""
+    with _CONNECTIONS_LOCK:
+        version = get_database_version(examples_path)
+        cached = _EXAMPLE_ROWS.get(examples_path)
+        if (cached is not None) and (cached[0] == version):
+            return cached[1]
+
+        _LOGGER.debug("Loading examples from %s", examples_path)
+        c = get_connection(examples_path).cursor()
+        try:
+            c.execute("SELECT sentence, path FROM intents ORDER BY rowid")
+            sentences: typing.List[str] = []
+            paths: typing.List[bytes] = []
+            for sentence, path in c:
+                sentences.append(sentence)
+                paths.append(path)
+        finally:
+            # Release read lock so the database can be retrained
+            c.close()
+
+        rows = ExampleRows(sentences, paths)
+        _EXAMPLE_ROWS[examples_path] = (version, rows)
+
+        return rows
+
+
+def get_connection(examples_path: str) -> sqlite3.Connection:
+    """Gets a cached read-only connection to an examples database"""
+    stat = os.stat(examples_path)
+    stamp = (stat.st_ino, stat.st_mtime_ns)
+
+    with _CONNECTIONS_LOCK:
+        cached = _CONNECTIONS.get(examples_path)
+        if cached is not None:
+            cached_stamp, _, conn = cached
+            if cached_stamp == stamp:
+                return conn
+
+            # Database file was replaced or retrained
+            conn.close()
+            del _CONNECTIONS[examples_path]
+
+        _LOGGER.debug("Opening examples database at %s", examples_path)
+        conn = sqlite3.connect(examples_path, check_same_thread=False)
+
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+        if version != EXAMPLES_DB_VERSION:
+            conn.close()
+            raise ValueError(
+                f"Examples database {examples_path} has format version {version} "
+                f"(expected {EXAMPLES_DB_VERSION}). Please retrain examples."
+            )
+
+        conn.execute("PRAGMA query_only = 1")
+        conn.execute("PRAGMA mmap_size = 268435456")
+        conn.execute("PRAGMA cache_size = -65536")
+
+        _CONNECTIONS[examples_path] = (stamp, next(_CONNECTION_IDS), conn)
+
+        return conn
+
+
+def get_database_version(examples_path: str) -> typing.Tuple[int, int]:
+    """Gets a value that changes whenever an examples database is modified"""
+    with _CONNECTIONS_LOCK:
+        conn = get_connection(examples_path)
+        connection_id = _CONNECTIONS[examples_path][1]
+
+        # Changes on every commit by another connection, including commits that
+        # are still in the write-ahead log (main database file is unchanged)
+        (data_version,) = conn.execute("PRAGMA data_version").fetchone()
+
+    return (connection_id, data_version)
 
-    result = rapidfuzz.process.extractOne(
-        [query], c, processor=lambda s: s[0], scorer=rapidfuzz.fuzz.ratio
+
+def close_connections(examples_path: typing.Optional[str] = None):
+    """Closes cached examples database connections (all by default)"""
+    with _CONNECTIONS_LOCK:
+        if examples_path is None:
+            for _, _, conn in _CONNECTIONS.values():
+                conn.close()
+
+            _CONNECTIONS.clear()
+            _EXAMPLE_ROWS.clear()
+        else:
+            cached = _CONNECTIONS.pop(str(examples_path), None)
+            if cached is not None:
+                cached[2].close()
+
+            _EXAMPLE_ROWS.pop(str(examples_path), None)
+
+
+def extract_one(
+    query: str,
+    examples: Examples,
+    path_filter: typing.Optional[PathFilterType] = None,
+) -> typing.Optional[MatchType]:
+    """Finds the best text/path for a query among in-memory examples"""
+    # Check for an exact match first
+    for index in examples.exact.get(query, []):
+        path = examples.paths[index]
+        if (path_filter is None) or path_filter(path):
+            return (query, path, 100.0)
+
+    example_paths = examples.paths
+    best = extract_one_lengths(
+        query,
+        examples.sentences,
+        examples.lengths,
+        lambda index: [(index, example_paths[index])],
+        path_filter=path_filter,
+    )
+
+    if best is None:
+        return None
+
+    best_score, _, best_index, best_path = best
+    return (examples.sentences[best_index], best_path, best_score)
+
+
+def extract_one_lengths(
+    query: str,
+    sentences: typing.Sequence[str],
+    lengths: typing.Dict[int, typing.List[int]],
+    get_paths: typing.Callable[[int], typing.List[IndexedPathType]],
+    path_filter: typing.Optional[PathFilterType] = None,
+) -> typing.Optional[ScoredMatchType]:
+    """Finds the best match for a query among sentences grouped by length.
+
+    get_paths returns the (example index, path) pairs of the sentence at an index.
+    Ties keep the earliest example with a path that passes the filter.
+    """
+    # Score the length bucket with the highest possible ratio first, then every
+    # other bucket that could still reach its best score in a single call.
+    query_len = len(query)
+    buckets = sorted(
+        (
+            (max_score(query_len, length), indexes)
+            for length, indexes in lengths.items()
+        ),
+        key=operator.itemgetter(0),
     )
 
-    if not result:
-        conn.close()
-        return result
+    if not buckets:
+        return None
+
+    _, indexes = buckets.pop()
+    best = extract_one_indexes(query, sentences, indexes, get_paths, path_filter)
+    best_score = best[0] if best is not None else 0.0
+
+    candidates = [
+        indexes
+        for bucket_score, indexes in buckets
+        if (bucket_score + _SCORE_TOLERANCE) >= best_score
+    ]
+    if len(candidates) == len(buckets):
+        # Nothing to prune, so score all sentences without building a subset
+        return extract_one_indexes(query, sentences, None, get_paths, path_filter)
+
+    result = extract_one_indexes(
+        query,
+        sentences,
+        list(itertools.chain.from_iterable(candidates)),
+        get_paths,
+        path_filter,
+    )
+
+    if (best is None) or (
+        (result is not None) and ((result[0], -result[1]) > (best[0], -best[1]))
+    ):
+        best = result
+
+    return best
 
-    c.execute("SELECT path FROM intents ORDER BY rowid LIMIT 1 OFFSET ?", (result[2],))
-    best_path = c.fetchone()[0]
 
-    conn.close()
+def extract_one_indexes(
+    query: str,
+    sentences: typing.Sequence[str],
+    indexes: typing.Optional[typing.Sequence[int]],
+    get_paths: typing.Callable[[int], typing.List[IndexedPathType]],
+    path_filter: typing.Optional[PathFilterType] = None,
+) -> typing.Optional[ScoredMatchType]:
+    """Finds the best match for a query among some (default: all) sentences"""
+    choices = sentences
+    if indexes is not None:
+        choices = [sentences[index] for index in indexes]
 
-    return (result[0][0], json.loads(best_path), result[1])
+    if not choices:
+        return None
+
+    scores = rapidfuzz.process.cdist(
+        [query],
+        choices,
+        scorer=rapidfuzz.fuzz.ratio,
+        processor=None,
+        dtype=np.dtype(np.float64),
+        workers=-1 if len(choices) > _PARALLEL_MIN_EXAMPLES else 1,
+    )[0]
+
+    def choice_paths(position: int) -> typing.List[IndexedPathType]:
+        return get_paths(position if indexes is None else indexes[position])
+
+    best = extract_best(scores, choice_paths, path_filter)
+    if best is None:
+        return None
+
+    position, example_index, path = best
+    sentence_index = position if indexes is None else indexes[position]
+
+    return (float(scores[position]), example_index, sentence_index, path)
+
+
+def max_score(query_len: int, sentence_len: int) -> float:
+    """Highest possible ratio between texts of the given lengths"""
+    return 200.0 * min(sentence_len, query_len) / max(sentence_len + query_len, 1)
 
 
 def recognize(
     input_text: str,
     intent_graph: nx.DiGraph,
-    examples_path: str,
+    examples: typing.Union[str, Examples],
     intent_filter: typing.Optional[typing.Callable[[str], bool]] = None,
     extra_converters: typing.Optional[
         typing.Dict[str, typing.Callable[..., typing.Any]]
     ] = None,
 ) -> typing.List[Recognition]:
-    """Find the closest matching intent(s)."""
+    """Find the closest matching intent(s).
+
+    Examples are either the path to a SQLite database written by
+    examples_to_sqlite or the in-memory result of train.
+    Matches are cached by intent_filter, so it must always give the same
+    answer for the same intent name.
+    """
     start_time = time.perf_counter()
-    intent_filter = intent_filter or (lambda i: True)
+
+    path_filter: typing.Optional[PathFilterType] = None
+    if intent_filter is not None:
+        path_filter = make_path_filter(intent_graph, intent_filter)
 
     # Find closest match
-    # pylint: disable=unpacking-non-sequence
-    best_text, best_path, best_score = extract_one_sqlite(
-        rapidfuzz.utils.default_process(input_text), examples_path
+    query = _default_process(input_text)
+    cache_key = match_cache_key(query, examples, intent_filter)
+    with _MATCH_CACHE_LOCK:
+        cached = _MATCH_CACHE.get(cache_key)
+        if cached is not None:
+            _MATCH_CACHE.move_to_end(cache_key)
+
+    if cached is not None:
+        result = cached[1]
+    else:
+        cached_examples: typing.Any = None
+        if isinstance(examples, (str, os.PathLike)):
+            result = extract_one_sqlite(query, str(examples), path_filter=path_filter)
+        else:
+            cached_examples = examples
+            result = extract_one(query, examples, path_filter=path_filter)
+
+        with _MATCH_CACHE_LOCK:
+            _MATCH_CACHE[cache_key] = (cached_examples, result)
+            if len(_MATCH_CACHE) > _MATCH_CACHE_SIZE:
+                _MATCH_CACHE.popitem(last=False)
+
+    if result is None:
+        # No examples (or none that pass the intent filter)
+        return []
+
+    return [
+        result_to_recognition(
+            input_text,
+            result,
+            intent_graph,
+            time.perf_counter() - start_time,
+            converters=get_converters(extra_converters),
+        )
+    ]
+
+
+def recognize_batch(
+    input_texts: typing.Sequence[str],
+    intent_graph: nx.DiGraph,
+    examples: typing.Union[str, Examples],
+    intent_filter: typing.Optional[typing.Callable[[str], bool]] = None,
+    extra_converters: typing.Optional[
+        typing.Dict[str, typing.Callable[..., typing.Any]]
+    ] = None,
+) -> typing.List[typing.List[Recognition]]:
+    """Find the closest matching intent(s) for many inputs at once.
+
+    Examples are either the path to a SQLite database written by
+    examples_to_sqlite or the in-memory result of train.
+    """
+    if not input_texts:
+        return []
+
+    start_time = time.perf_counter()
+
+    path_filter: typing.Optional[PathFilterType] = None
+    if intent_filter is not None:
+        path_filter = make_path_filter(intent_graph, intent_filter)
+
+    # Find closest matches
+    queries = [_default_process(input_text) for input_text in input_texts]
+    if isinstance(examples, (str, os.PathLike)):
+        results = extract_many_sqlite(queries, str(examples), path_filter=path_filter)
+    else:
+        example_paths = examples.paths
+        results = extract_many(
+            queries,
+            examples.sentences,
+            lambda index: [(index, example_paths[index])],
+            path_filter=path_filter,
+        )
+
+    # Scoring time is shared by all inputs
+    recognize_seconds = (time.perf_counter() - start_time) / len(input_texts)
+
+    if extra_converters:
+        # Inputs in a batch often convert the same values
+        extra_converters = memoize_converters(extra_converters)
+
+    converters = get_converters(extra_converters)
+
+    all_recognitions: typing.List[typing.List[Recognition]] = []
+    for input_text, result in zip(input_texts, results):
+        if result is None:
+            # No examples (or none that pass the intent filter)
+            all_recognitions.append([])
+            continue
+
+        all_recognitions.append(
+            [
+                result_to_recognition(
+                    input_text,
+                    result,
+                    intent_graph,
+                    recognize_seconds,
+                    converters=converters,
+                )
+            ]
+        )
+
+    return all_recognitions
+
+
+def extract_many_sqlite(
+    queries: typing.Sequence[str],
+    examples_path: str,
+    path_filter: typing.Optional[PathFilterType] = None,
+) -> typing.List[typing.Optional[MatchType]]:
+    """Finds the best text/path for each query, scoring all queries in batches"""
+    rows = get_example_rows(examples_path)
+    row_paths = rows.paths
+
+    return extract_many(
+        queries,
+        rows.sentences,
+        lambda index: blob_to_paths(row_paths[index]),
+        path_filter=path_filter,
     )
+
+
+def extract_many(
+    queries: typing.Sequence[str],
+    sentences: typing.Sequence[str],
+    get_paths: typing.Callable[[int], typing.List[IndexedPathType]],
+    path_filter: typing.Optional[PathFilterType] = None,
+) -> typing.List[typing.Optional[MatchType]]:
+    """Finds the best text/path for each query, scoring all queries in batches.
+
+    get_paths returns the (example index, path) pairs of the sentence at an index.
+    """
+    if not sentences:
+        return [None for _ in queries]
+
+    batch_size = max(1, _MAX_BATCH_SCORES // len(sentences))
+    results: typing.List[typing.Optional[MatchType]] = []
+
+    for batch_start in range(0, len(queries), batch_size):
+        # queries x sentences matrix, computed in parallel outside the GIL
+        scores = rapidfuzz.process.cdist(
+            queries[batch_start : batch_start + batch_size],
+            sentences,
+            scorer=rapidfuzz.fuzz.ratio,
+            processor=None,
+            dtype=np.dtype(np.float64),
+            workers=-1,
+        )
+
+        for query_scores in scores:
+            result: typing.Optional[MatchType] = None
+            best = extract_best(query_scores, get_paths, path_filter)
+            if best is not None:
+                best_index, _, best_path = best
+                result = (
+                    sentences[best_index],
+                    best_path,
+                    float(query_scores[best_index]),
+                )
+
+            results.append(result)
+
+    return results
+
+
+def extract_best(
+    scores: typing.Any,
+    get_paths: typing.Callable[[int], typing.List[IndexedPathType]],
+    path_filter: typing.Optional[PathFilterType] = None,
+) -> typing.Optional[RankedMatchType]:
+    """Finds the best sentence index/example index/path given a query's scores.
+
+    Ties keep the earliest example with a path that passes the filter.
+    """
+    # Check the top sentences first, only ranking all sentences if they are all
+    # filtered out
+    top_score = scores[int(scores.argmax())]
+    best = extract_ranked(
+        np.flatnonzero(scores == top_score).tolist(), scores, get_paths, path_filter
+    )
+    if (best is None) and (path_filter is not None):
+        best = extract_ranked(
+            np.argsort(-scores, kind="stable").tolist(),
+            scores,
+            get_paths,
+            path_filter,
+        )
+
+    return best
+
+
+def extract_ranked(
+    sentence_indexes: typing.Iterable[int],
+    scores: typing.Any,
+    get_paths: typing.Callable[[int], typing.List[IndexedPathType]],
+    path_filter: typing.Optional[PathFilterType] = None,
+) -> typing.Optional[RankedMatchType]:
+    """Finds the best match among sentences in decreasing score order.
+
+    Ties keep the earliest example with a path that passes the filter.
+    """
+    best: typing.Optional[RankedMatchType] = None
+    best_score = -1.0
+    best_example_index = -1
+
+    for sentence_index in sentence_indexes:
+        score = float(scores[sentence_index])
+        if score < best_score:
+            break
+
+        for example_index, path in get_paths(sentence_index):
+            if (path_filter is None) or path_filter(path):
+                if (best is None) or (example_index < best_example_index):
+                    best = (sentence_index, example_index, path)
+                    best_score = score
+                    best_example_index = example_index
+
+                break
+
+    return best
+
+
+def result_to_recognition(
+    input_text: str,
+    result: MatchType,
+    intent_graph: nx.DiGraph,
+    recognize_seconds: float,
+    converters: typing.Optional[
+        typing.Dict[str, typing.Callable[..., typing.Any]]
+    ] = None,
+) -> Recognition:
+    """Converts a best text/path/score match into a recognition.
+
+    converters replace the built-in converters (see get_converters).
+    """
+    best_text, best_path, best_score = result
     _LOGGER.debug("input=%s, match=%s, score=%s", input_text, best_text, best_score)
 
-    end_time = time.perf_counter()
     _, recognition = rhasspynlu.fsticuffs.path_to_recognition(
-        best_path, intent_graph, extra_converters=extra_converters
+        best_path, intent_graph, converters=converters
     )
 
     assert recognition and recognition.intent, "Failed to find a match"
     recognition.intent.confidence = best_score / 100.0
-    recognition.recognize_seconds = end_time - start_time
+    recognition.recognize_seconds = recognize_seconds
     recognition.raw_text = input_text
     recognition.raw_tokens = input_text.split()
 
-    return [recognition]
+    return recognition
+
+
+def make_path_filter(
+    intent_graph: nx.DiGraph, intent_filter: typing.Callable[[str], bool]
+) -> PathFilterType:
+    """Creates a node path filter from an intent name filter."""
+    # Decisions for each intent's first edge, shared by all of its paths
+    edge_allowed: typing.Dict[typing.Tuple[int, int], bool] = {}
+
+    def path_filter(path: typing.List[int]) -> bool:
+        edge = (path[0], path[1])
+        allowed = edge_allowed.get(edge)
+        if allowed is None:
+            # First edge has intent name (__label__INTENT)
+            olabel = intent_graph.edges[edge]["olabel"]
+            allowed = bool(intent_filter(olabel[9:]))
+            edge_allowed[edge] = allowed
+
+        return allowed
+
+    return path_filter
+
+
+def get_converters(
+    extra_converters: typing.Optional[
+        typing.Dict[str, typing.Callable[..., typing.Any]]
+    ] = None,
+) -> typing.Dict[str, typing.Callable[..., typing.Any]]:
+    """Combines built-in converters with extra converters."""
+    if not extra_converters:
+        return _DEFAULT_CONVERTERS
+
+    return {**_DEFAULT_CONVERTERS, **extra_converters}
+
+
+def memoize_converters(
+    converters: typing.Dict[str, typing.Callable[..., typing.Any]]
+) -> typing.Dict[str, typing.Callable[..., typing.Any]]:
+    """Wraps converters to reuse results for repeated arguments."""
+    return {name: memoize_converter(func) for name, func in converters.items()}
+
+
+def memoize_converter(
+    func: typing.Callable[..., typing.Any]
+) -> typing.Callable[..., typing.Any]:
+    """Wraps a converter to reuse results for repeated arguments.
+
+    Only results made of immutable scalars are reused.
+    """
+    results: typing.Dict[typing.Hashable, typing.List[typing.Any]] = {}
+
+    def converter(*args, **kwargs):
+        key = (
+            args,
+            tuple(
+                (name, tuple(value) if isinstance(value, list) else value)
+                for name, value in kwargs.items()
+            ),
+        )
+
+        try:
+            result = results.get(key)
+        except TypeError:
+            # Unhashable values
+            return func(*args, **kwargs)
+
+        if result is None:
+            result = list(func(*args, **kwargs))
+            if not all(isinstance(value, _SCALAR_TYPES) for value in result):
+                # Mutable values (e.g. dicts) can't be shared between recognitions
+                return result
+
+            results[key] = result
+
+        # Callers may modify the returned list
+        return list(result)
+
+    return converter
+
+
+def match_cache_key(
+    query: str,
+    examples: typing.Union[str, Examples],
+    intent_filter: typing.Optional[typing.Callable[[str], bool]],
+) -> typing.Hashable:
+    """Gets the key of a query's match in the cache."""
+    if isinstance(examples, (str, os.PathLike)):
+        # Retraining changes the database version
+        examples_path = str(examples)
+        version = get_database_version(examples_path)
+        return (query, examples_path, version, intent_filter)
+
+    return (query, id(examples), intent_filter)
+
+
+def clear_cache():
+    """Clears cached matches."""
+    with _MATCH_CACHE_LOCK:
+        _MATCH_CACHE.clear()
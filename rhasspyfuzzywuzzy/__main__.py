@@ -3,7 +3,6 @@ import argparse
 import json
 import logging
 import os
-import sqlite3
 import sys
 import typing
 from pathlib import Path
@@ -11,8 +10,11 @@ from pathlib import Path
 import rhasspynlu
 from rhasspynlu.intent import Recognition
 
+from . import examples_to_sqlite as fuzzywuzzy_examples_to_sqlite
 from . import recognize as fuzzywuzzy_recognize
+from . import recognize_batch as fuzzywuzzy_recognize_batch
 from . import train as fuzzywuzzy_train
+from . import train_iter as fuzzywuzzy_train_iter
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -65,6 +67,11 @@ def get_args() -> argparse.Namespace:
         default="ignore",
         help="Case transformation applied to query text",
     )
+    recognize_parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Read all queries from stdin before recognizing them together",
+    )
     recognize_parser.add_argument("query", nargs="*", help="Query input sentences")
 
     # -------------------------------------------------------------------------
@@ -110,6 +117,7 @@ def recognize(args: argparse.Namespace):
         word_transform = get_word_transform(args.word_casing)
 
         # Process queries
+        sentences: typing.Iterable[str]
         if args.query:
             sentences = args.query
         else:
@@ -118,16 +126,23 @@ def recognize(args: argparse.Namespace):
 
             sentences = sys.stdin
 
-        for sentence in sentences:
-            # Handle casing
-            sentence = sentence.strip()
-            sentence = word_transform(sentence)
+        # Handle casing
+        sentences = (word_transform(sentence.strip()) for sentence in sentences)
 
-            # Do recognition
-            recognitions = fuzzywuzzy_recognize(
-                sentence, intent_graph, str(args.examples)
+        all_recognitions: typing.Iterable[typing.List[Recognition]]
+        if args.query or args.batch:
+            # Score all queries together
+            all_recognitions = fuzzywuzzy_recognize_batch(
+                list(sentences), intent_graph, str(args.examples)
+            )
+        else:
+            # Score queries one at a time as they arrive
+            all_recognitions = (
+                fuzzywuzzy_recognize(sentence, intent_graph, str(args.examples))
+                for sentence in sentences
             )
 
+        for recognitions in all_recognitions:
             if recognitions:
                 # Intent recognized
                 recognition = recognitions[0]
@@ -166,38 +181,22 @@ def train(args: argparse.Namespace):
 
         graph_dict = json.load(sys.stdin)
 
-    if args.slots:
-        args.slots = [Path(p) for p in args.slots]
-
-    if args.slot_programs:
-        args.slot_programs = [Path(p) for p in args.slot_programs]
+    intent_graph = rhasspynlu.json_to_graph(graph_dict)
 
     # -------------------------------------------------------------------------
 
     # Do training
-    examples = fuzzywuzzy_train(graph_dict)
-
     if args.examples:
-        # Write examples to SQLite database
-        conn = sqlite3.connect(str(args.examples))
-        c = conn.cursor()
-        c.execute("""DROP TABLE IF EXISTS intents""")
-        c.execute("""CREATE TABLE intents (sentence text, path text)""")
-
-        for _, sentences in examples.items():
-            for sentence, path in sentences.items():
-                c.execute(
-                    "INSERT INTO intents VALUES (?, ?)",
-                    (sentence, json.dumps(path, ensure_ascii=False)),
-                )
-
-        conn.commit()
-        conn.close()
+        # Stream examples into SQLite database
+        fuzzywuzzy_examples_to_sqlite(
+            fuzzywuzzy_train_iter(intent_graph), str(args.examples)
+        )
 
         _LOGGER.debug("Wrote %s", str(args.examples))
     else:
         # Write results to stdout
-        json.dump(examples, sys.stdout, ensure_ascii=False)
+        examples = fuzzywuzzy_train(intent_graph)
+        json.dump(list(examples), sys.stdout, ensure_ascii=False)
         print("")
         sys.stdout.flush()
 
@@ -213,7 +212,8 @@ def get_word_transform(name: str) -> typing.Callable[[str], str]:
     if name == "lower":
         return str.lower
 
-    return lambda s: s
+    # str() hands back str objects unchanged without a Python-level call
+    return str
 
 
 # -----------------------------------------------------------------------------
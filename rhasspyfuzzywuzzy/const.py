@@ -1,4 +1,75 @@
 """Types and constants."""
 import typing
+from dataclasses import dataclass, field
 
-ExamplesType = typing.Dict[str, typing.Dict[str, typing.List[int]]]
+ExampleType = typing.Tuple[str, str, typing.List[int]]
+
+# (example index, node path)
+IndexedPathType = typing.Tuple[int, typing.List[int]]
+
+# Layout of examples databases written by examples_to_sqlite (PRAGMA user_version).
+# Databases from older releases have version 0 and must be retrained.
+EXAMPLES_DB_VERSION = 1
+
+
+@dataclass
+class Examples:
+    """Training examples as parallel lists of intents, sentences, and paths."""
+
+    intents: typing.List[str] = field(default_factory=list)
+    sentences: typing.List[str] = field(default_factory=list)
+    paths: typing.List[typing.List[int]] = field(default_factory=list)
+
+    # Sentence -> indexes of examples with that exact sentence
+    exact: typing.Dict[str, typing.List[int]] = field(init=False)
+
+    # Sentence length -> indexes of examples with that length
+    lengths: typing.Dict[int, typing.List[int]] = field(init=False)
+
+    def __post_init__(self):
+        self.exact = {}
+        self.lengths = {}
+        for index, sentence in enumerate(self.sentences):
+            self.exact.setdefault(sentence, []).append(index)
+            self.lengths.setdefault(len(sentence), []).append(index)
+
+    def add(self, intent_name: str, sentence: str, path: typing.List[int]):
+        """Append an example and index its sentence."""
+        index = len(self.sentences)
+        self.intents.append(intent_name)
+        self.sentences.append(sentence)
+        self.paths.append(path)
+        self.exact.setdefault(sentence, []).append(index)
+        self.lengths.setdefault(len(sentence), []).append(index)
+
+    def __len__(self) -> int:
+        return len(self.sentences)
+
+    def __iter__(self) -> typing.Iterator[ExampleType]:
+        return zip(self.intents, self.sentences, self.paths)
+
+
+@dataclass
+class ExampleRows:
+    """Unique sentences of an examples database and their packed paths."""
+
+    sentences: typing.List[str] = field(default_factory=list)
+
+    # Packed (example index, path) pairs of each sentence (see paths_to_blob)
+    paths: typing.List[bytes] = field(default_factory=list)
+
+    # Sentence -> index of its row
+    exact: typing.Dict[str, int] = field(init=False)
+
+    # Sentence length -> indexes of rows with that length
+    lengths: typing.Dict[int, typing.List[int]] = field(init=False)
+
+    def __post_init__(self):
+        self.exact = {}
+        self.lengths = {}
+        for index, sentence in enumerate(self.sentences):
+            self.exact[sentence] = index
+            self.lengths.setdefault(len(sentence), []).append(index)
+
+    def __len__(self) -> int:
+        return len(self.sentences)
@@ -1,32 +1,142 @@
 """Training methods for rhasspyfuzzywuzzy"""
+import array
+import itertools
 import logging
+import operator
+import sqlite3
+import sys
 import typing
-from collections import defaultdict
 
 import networkx as nx
 import rapidfuzz.utils as fuzz_utils
 import rhasspynlu
 
-from .const import ExamplesType
+from .const import EXAMPLES_DB_VERSION, Examples, ExampleType, IndexedPathType
 
 _LOGGER = logging.getLogger(__name__)
 
 # -----------------------------------------------------------------------------
 
 
-def train(intent_graph: nx.DiGraph) -> ExamplesType:
+def train(intent_graph: nx.DiGraph) -> Examples:
     """Generate examples from intent graph."""
+    clear_caches()
+
+    examples = Examples()
+    add_example = examples.add
+
+    for intent_name, sentence, path in train_iter(intent_graph):
+        add_example(intent_name, sentence, path)
+
+    return examples
+
+
+def train_iter(intent_graph: nx.DiGraph) -> typing.Iterable[ExampleType]:
+    """Generate (intent, sentence, path) examples from intent graph.
+
+    Sentences are normalized with rapidfuzz's default_process here, so they
+    can be scored during recognition without a processor.
+    """
 
     # Generate all possible intents
     _LOGGER.debug("Generating examples")
-    examples: ExamplesType = defaultdict(dict)
+    default_process = fuzz_utils.default_process
     for intent_name, words, path in generate_examples(intent_graph):
-        sentence = fuzz_utils.default_process(" ".join(words))
-        examples[intent_name][sentence] = path
+        yield (intent_name, default_process(" ".join(words)), path)
 
     _LOGGER.debug("Examples generated")
 
-    return examples
+
+def examples_to_sqlite(examples: typing.Iterable[ExampleType], examples_path: str):
+    """Write (intent, sentence, path) examples to a SQLite database."""
+    clear_caches(examples_path)
+
+    conn = sqlite3.connect(examples_path, isolation_level=None)
+    c = conn.cursor()
+
+    # Database is rebuilt from scratch, so durability is not a concern
+    c.execute("PRAGMA journal_mode = WAL")
+    c.execute("PRAGMA synchronous = OFF")
+
+    c.execute("BEGIN")
+    c.execute("DROP TABLE IF EXISTS intents")
+    c.execute("CREATE TABLE intents (sentence text, path blob)")
+
+    # Stream examples into a staging table instead of holding them in memory
+    c.execute("CREATE TEMP TABLE examples (sentence text, path blob)")
+    c.executemany(
+        "INSERT INTO examples VALUES (?, ?)",
+        (
+            (sentence, paths_to_blob([(index, path)]))
+            for index, (_, sentence, path) in enumerate(examples)
+        ),
+    )
+
+    # Identical sentences from different intents are only scored once.
+    # Sentences keep the order in which they were first generated.
+    # Without an index, each sentence's group is found by a full scan.
+    c.execute("CREATE INDEX temp.examples_sentence ON examples (sentence)")
+    sentence_paths = conn.execute(
+        "SELECT sentence, path FROM examples "
+        "JOIN (SELECT sentence, min(rowid) AS first_id FROM examples "
+        "GROUP BY sentence) USING (sentence) "
+        "ORDER BY first_id, examples.rowid"
+    )
+    c.executemany(
+        "INSERT INTO intents VALUES (?, ?)",
+        (
+            (sentence, b"".join(path for _, path in rows))
+            for sentence, rows in itertools.groupby(
+                sentence_paths, key=operator.itemgetter(0)
+            )
+        ),
+    )
+    c.execute("DROP TABLE examples")
+    c.execute("CREATE UNIQUE INDEX intents_sentence ON intents (sentence)")
+    c.execute(f"PRAGMA user_version = {EXAMPLES_DB_VERSION}")
+
+    c.execute("COMMIT")
+    conn.close()
+
+
+def clear_caches(examples_path: typing.Optional[str] = None):
+    """Drops cached matches and any cached connection to a retrained database."""
+    # Imported here since the package imports this module
+    from . import clear_cache, close_connections
+
+    clear_cache()
+    if examples_path is not None:
+        close_connections(examples_path)
+
+
+def paths_to_blob(paths: typing.Iterable[IndexedPathType]) -> bytes:
+    """Pack (example index, node path) pairs into a SQLite blob.
+
+    Each path is prefixed with its example index and terminated by -1.
+    """
+    values = array.array("i")
+    for index, path in paths:
+        values.append(index)
+        values.extend(path)
+        values.append(-1)
+
+    return values.tobytes()
+
+
+def blob_to_paths(blob: bytes) -> typing.List[IndexedPathType]:
+    """Unpack (example index, node path) pairs from a SQLite blob."""
+    values = array.array("i")
+    values.frombytes(blob)
+    node_ids = values.tolist()
+
+    paths = []
+    start = 0
+    while start < len(node_ids):
+        end = node_ids.index(-1, start)
+        paths.append((node_ids[start], node_ids[start + 1 : end]))
+        start = end + 1
+
+    return paths
 
 
 # -----------------------------------------------------------------------------
@@ -36,7 +146,9 @@ def generate_examples(
     intent_graph: nx.DiGraph,
 ) -> typing.Iterable[typing.Tuple[str, typing.List[str], typing.List[int]]]:
     """Generate all possible sentences/paths from an intent graph."""
-    n_data = intent_graph.nodes(data=True)
+    # Look up node words and edges once instead of per path
+    node_words = {node: word for node, word in intent_graph.nodes(data="word") if word}
+    adjacency = intent_graph.adj
 
     # Get start/end nodes for graph
     start_node, end_node = rhasspynlu.jsgf_graph.get_start_end_nodes(intent_graph)
@@ -45,19 +157,41 @@ def generate_examples(
     ), "Missing start/end node(s)"
 
     # Generate all sentences/paths
-    paths = nx.all_simple_paths(intent_graph, start_node, end_node)
-    for path in paths:
+    for path in generate_paths(intent_graph, start_node, end_node):
         assert len(path) > 2
 
         # First edge has intent name (__label__INTENT)
-        olabel = intent_graph.edges[(path[0], path[1])]["olabel"]
+        olabel = adjacency[path[0]][path[1]]["olabel"]
         assert olabel.startswith("__label__")
-        intent_name = olabel[9:]
 
-        sentence = []
-        for node in path:
-            word = n_data[node].get("word")
-            if word:
-                sentence.append(word)
+        # Interned so all examples of an intent share one name string
+        intent_name = sys.intern(olabel[9:])
+
+        sentence = [node_words[node] for node in path if node in node_words]
 
         yield (intent_name, sentence, path)
+
+
+def generate_paths(
+    intent_graph: nx.DiGraph, start_node: int, end_node: int
+) -> typing.Iterable[typing.List[int]]:
+    """Generate all paths from start to end node with an iterative depth-first search.
+
+    Intent graphs are acyclic, so visited nodes are not tracked.
+    """
+    # Look up successors once instead of on every visit
+    successors = {node: list(intent_graph.successors(node)) for node in intent_graph}
+
+    path = [start_node]
+    stack = [iter(successors[start_node])]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            # Backtrack
+            stack.pop()
+            path.pop()
+        elif child == end_node:
+            yield path + [child]
+        else:
+            path.append(child)
+            stack.append(iter(successors[child]))
@@ -1,17 +1,34 @@
 """Test cases for recognition functions."""
+import os
+import sqlite3
+import tempfile
+import time
 import unittest
+from unittest.mock import ANY
 
 from rhasspynlu.ini_jsgf import parse_ini
 from rhasspynlu.intent import Intent, Recognition
 from rhasspynlu.jsgf import Sentence
 from rhasspynlu.jsgf_graph import intents_to_graph
 
-from rhasspyfuzzywuzzy import recognize, train
+from rhasspyfuzzywuzzy import (
+    close_connections,
+    examples_to_sqlite,
+    memoize_converter,
+    recognize,
+    recognize_batch,
+    train,
+    train_iter,
+)
 
 
 class RecognizeTestCase(unittest.TestCase):
     """Recognition test cases."""
 
+    def tearDown(self):
+        # Connections to temporary examples databases
+        close_connections()
+
     def test_single_sentence(self):
         """Single intent, single sentence."""
         intents = parse_ini(
@@ -25,7 +42,7 @@ class RecognizeTestCase(unittest.TestCase):
         examples = train(graph)
 
         # Exact
-        recognitions = zero_times(recognize("this is a test", graph, examples))
+        recognitions = recognize("this is a test", graph, examples)
 
         self.assertEqual(
             recognitions,
@@ -36,13 +53,14 @@ class RecognizeTestCase(unittest.TestCase):
                     raw_text="this is a test",
                     tokens=["this", "is", "a", "test?"],
                     raw_tokens=["this", "is", "a", "test"],
+                    recognize_seconds=ANY,
                 )
             ],
         )
 
         # Mispellings, too many tokens (lower confidence)
         for sentence in ["this is a bad test", "this iz b tst"]:
-            recognitions = zero_times(recognize(sentence, graph, examples))
+            recognitions = recognize(sentence, graph, examples)
             self.assertEqual(len(recognitions), 1)
 
             intent = recognitions[0].intent
@@ -62,13 +80,11 @@ class RecognizeTestCase(unittest.TestCase):
         examples = train(graph)
 
         # Should upper-case "test" and convert "ten" -> 10 -> 100
-        recognitions = zero_times(
-            recognize(
-                "this is a test ten",
-                graph,
-                examples,
-                extra_converters={"square": lambda *args: [x ** 2 for x in args]},
-            )
+        recognitions = recognize(
+            "this is a test ten",
+            graph,
+            examples,
+            extra_converters={"square": lambda *args: [x ** 2 for x in args]},
         )
         self.assertEqual(
             recognitions,
@@ -79,6 +95,7 @@ class RecognizeTestCase(unittest.TestCase):
                     raw_text="this is a test ten",
                     tokens=["this", "is", "a", "TEST", 100],
                     raw_tokens=["this", "is", "a", "test", "ten"],
+                    recognize_seconds=ANY,
                 )
             ],
         )
@@ -100,13 +117,11 @@ class RecognizeTestCase(unittest.TestCase):
             return [x ** exponent for x in args]
 
         # Should convert "ten" -> 10 -> 1000
-        recognitions = zero_times(
-            recognize(
-                "this is a test ten",
-                graph,
-                examples,
-                extra_converters={"pow": pow_converter},
-            )
+        recognitions = recognize(
+            "this is a test ten",
+            graph,
+            examples,
+            extra_converters={"pow": pow_converter},
         )
         self.assertEqual(
             recognitions,
@@ -117,6 +132,7 @@ class RecognizeTestCase(unittest.TestCase):
                     raw_text="this is a test ten",
                     tokens=["this", "is", "a", "test", 1000],
                     raw_tokens=["this", "is", "a", "test", "ten"],
+                    recognize_seconds=ANY,
                 )
             ],
         )
@@ -140,8 +156,8 @@ class RecognizeTestCase(unittest.TestCase):
             return name == "TestIntent1"
 
         # Should produce a recognition for first intent only
-        recognitions = zero_times(
-            recognize("this is a test", graph, examples, intent_filter=intent_filter)
+        recognitions = recognize(
+            "this is a test", graph, examples, intent_filter=intent_filter
         )
         self.assertEqual(
             recognitions,
@@ -152,10 +168,73 @@ class RecognizeTestCase(unittest.TestCase):
                     raw_text="this is a test",
                     tokens=["this", "is", "a", "test"],
                     raw_tokens=["this", "is", "a", "test"],
+                    recognize_seconds=ANY,
                 )
             ],
         )
 
+    def test_intent_filter_sqlite(self):
+        """Identical sentences from two different intents with filter (SQLite)."""
+        intents = parse_ini(
+            """
+        [TestIntent1]
+        this is a test
+
+        [TestIntent2]
+        this is a test
+        """
+        )
+
+        graph = intents_to_graph(intents)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            examples_path = os.path.join(temp_dir, "examples.db")
+            examples_to_sqlite(train_iter(graph), examples_path)
+
+            # Identical sentences share a row
+            conn = sqlite3.connect(examples_path)
+            (num_rows,) = conn.execute("SELECT COUNT(*) FROM intents").fetchone()
+            conn.close()
+            self.assertEqual(num_rows, 1)
+
+            # Exact and misspelled, allowing either intent
+            for intent_name in ["TestIntent1", "TestIntent2"]:
+                recognitions = recognize(
+                    "this is a test",
+                    graph,
+                    examples_path,
+                    intent_filter=intent_name.__eq__,
+                )
+                self.assertEqual(
+                    recognitions,
+                    [
+                        Recognition(
+                            intent=Intent(name=intent_name, confidence=1),
+                            text="this is a test",
+                            raw_text="this is a test",
+                            tokens=["this", "is", "a", "test"],
+                            raw_tokens=["this", "is", "a", "test"],
+                            recognize_seconds=ANY,
+                        )
+                    ],
+                )
+
+                recognitions = recognize(
+                    "this is a tst",
+                    graph,
+                    examples_path,
+                    intent_filter=intent_name.__eq__,
+                )
+                self.assertEqual(len(recognitions), 1)
+                self.assertEqual(recognitions[0].intent.name, intent_name)
+                self.assertLess(recognitions[0].intent.confidence, 1.0)
+
+            # No intent allowed
+            recognitions = recognize(
+                "this is a test", graph, examples_path, intent_filter=lambda name: False
+            )
+            self.assertEqual(recognitions, [])
+
     def test_rules(self):
         """Make sure local and remote rules work."""
         intents = parse_ini(
@@ -174,7 +253,7 @@ class RecognizeTestCase(unittest.TestCase):
         examples = train(graph)
 
         # Lower confidence with no stop words
-        recognitions = zero_times(recognize("this is another test", graph, examples))
+        recognitions = recognize("this is another test", graph, examples)
         self.assertEqual(
             recognitions,
             [
@@ -184,6 +263,7 @@ class RecognizeTestCase(unittest.TestCase):
                     raw_text="this is another test",
                     tokens=["this", "is", "another", "test"],
                     raw_tokens=["this", "is", "another", "test"],
+                    recognize_seconds=ANY,
                 )
             ],
         )
@@ -203,16 +283,14 @@ class RecognizeTestCase(unittest.TestCase):
         graph = intents_to_graph(parse_ini(ini_text), replacements)
         examples = train(graph)
 
-        recognitions = zero_times(
-            recognize(
-                "read me the hound of the baskervilles in the bedroom", graph, examples
-            )
+        recognitions = recognize(
+            "read me the hound of the baskervilles in the bedroom", graph, examples
         )
         self.assertEqual(len(recognitions), 1)
         recognition = recognitions[0]
         self.assertTrue(recognition.intent)
 
-        entities = {e.entity: e for e in recognition.entities}
+        entities = entities_by_name(recognition)
         self.assertIn("book", entities)
         book = entities["book"]
         self.assertEqual(book.value, "the hound of the baskervilles")
@@ -234,13 +312,13 @@ class RecognizeTestCase(unittest.TestCase):
         examples = train(graph)
 
         # ten -> 10 (int)
-        recognitions = zero_times(recognize("this is a test ten", graph, examples))
+        recognitions = recognize("this is a test ten", graph, examples)
 
         self.assertEqual(len(recognitions), 1)
         recognition = recognitions[0]
         self.assertTrue(recognition.intent)
 
-        entities = {e.entity: e for e in recognition.entities}
+        entities = entities_by_name(recognition)
         self.assertIn("number", entities)
         number = entities["number"]
         self.assertEqual(number.value, 10)
@@ -258,15 +336,13 @@ class RecognizeTestCase(unittest.TestCase):
         examples = train(graph)
 
         # "four point two" -> 4.2
-        recognitions = zero_times(
-            recognize("this is a test four point two", graph, examples)
-        )
+        recognitions = recognize("this is a test four point two", graph, examples)
 
         self.assertEqual(len(recognitions), 1)
         recognition = recognitions[0]
         self.assertTrue(recognition.intent)
 
-        entities = {e.entity: e for e in recognition.entities}
+        entities = entities_by_name(recognition)
         self.assertIn("number", entities)
         number = entities["number"]
         self.assertEqual(number.value, 4.2)
@@ -284,20 +360,18 @@ class RecognizeTestCase(unittest.TestCase):
         examples = train(graph)
 
         # "four two" -> 4.2
-        recognitions = zero_times(
-            recognize(
-                "this is a test four point two",
-                graph,
-                examples,
-                extra_converters={"floatify": lambda a, b: [float(f"{a}.{b}")]},
-            )
+        recognitions = recognize(
+            "this is a test four point two",
+            graph,
+            examples,
+            extra_converters={"floatify": lambda a, b: [float(f"{a}.{b}")]},
         )
 
         self.assertEqual(len(recognitions), 1)
         recognition = recognitions[0]
         self.assertTrue(recognition.intent)
 
-        entities = {e.entity: e for e in recognition.entities}
+        entities = entities_by_name(recognition)
         self.assertIn("number", entities)
         number = entities["number"]
         self.assertEqual(number.value, 4.2)
@@ -315,7 +389,7 @@ class RecognizeTestCase(unittest.TestCase):
         examples = train(graph)
 
         # Should upper-case "is a test"
-        recognitions = zero_times(recognize("this is a test", graph, examples))
+        recognitions = recognize("this is a test", graph, examples)
         self.assertEqual(
             recognitions,
             [
@@ -325,17 +399,246 @@ class RecognizeTestCase(unittest.TestCase):
                     raw_text="this is a test",
                     tokens=["this", "IS", "A", "TEST"],
                     raw_tokens=["this", "is", "a", "test"],
+                    recognize_seconds=ANY,
                 )
             ],
         )
 
+    def test_memoize_converter(self):
+        """Repeated converter calls reuse scalar results only."""
+        calls = []
+
+        def pow_converter(*args, converter_args=None):
+            calls.append(args)
+            exponent = int(converter_args[0]) if converter_args else 1
+            return [x ** exponent for x in args]
+
+        converter = memoize_converter(pow_converter)
+        self.assertEqual(converter(10, converter_args=["3"]), [1000])
+
+        # Callers get their own list
+        converter(10, converter_args=["3"]).append(0)
+        self.assertEqual(converter(10, converter_args=["3"]), [1000])
+        self.assertEqual(calls, [(10,)])
+
+        # Different converter arguments
+        self.assertEqual(converter(10, converter_args=["2"]), [100])
+        self.assertEqual(calls, [(10,), (10,)])
+
+        # Unhashable values are converted without caching
+        converter = memoize_converter(lambda *args: [len(args[0])])
+        self.assertEqual(converter([1, 2]), [2])
+
+        # Mutable values are not shared
+        converter = memoize_converter(lambda *args: [{"value": list(args)}])
+        converter("a")[0]["value"].append("b")
+        self.assertEqual(converter("a"), [{"value": ["a"]}])
+
+    def test_sqlite_batch_parity(self):
+        """In-memory, SQLite, and batch recognition find the same matches."""
+        intents = parse_ini(
+            """
+        [TurnOn]
+        turn on the (living room | kitchen) light
+        toggle the light
+
+        [TurnOff]
+        turn off the (living room | kitchen) light
+        toggle the light
+
+        [Animal]
+        lamb
+        test
+
+        [Weather]
+        damp
+        tst foo bar baz qux quux corge grault
+        """
+        )
+
+        graph = intents_to_graph(intents)
+        examples = train(graph)
+
+        # Exact, misspelled, tied, and unrelated queries
+        texts = [
+            "turn on the kitchen light",
+            "turn of the kitchen lite",
+            "toggle the light",
+            "toggle the lite",
+            "lamp",
+            "tst",
+            "xyz",
+        ]
+
+        intent_filters = [
+            None,
+            {"TurnOff", "Weather"}.__contains__,
+            "Weather".__eq__,
+        ]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            examples_path = os.path.join(temp_dir, "examples.db")
+            examples_to_sqlite(train_iter(graph), examples_path)
+
+            for intent_filter in intent_filters:
+                expected = [
+                    summarize(
+                        recognize(text, graph, examples, intent_filter=intent_filter)
+                    )
+                    for text in texts
+                ]
+
+                for text, expected_summary in zip(texts, expected):
+                    self.assertEqual(
+                        summarize(
+                            recognize(
+                                text, graph, examples_path, intent_filter=intent_filter
+                            )
+                        ),
+                        expected_summary,
+                    )
+
+                for batch_examples in [examples, examples_path]:
+                    self.assertEqual(
+                        [
+                            summarize(recognitions)
+                            for recognitions in recognize_batch(
+                                texts,
+                                graph,
+                                batch_examples,
+                                intent_filter=intent_filter,
+                            )
+                        ],
+                        expected,
+                    )
+
+            # Best match shares no word with the query
+            self.assertEqual(
+                summarize(recognize("tst", graph, examples_path)),
+                [("Animal", "test", ANY)],
+            )
+
+            # Tie broken by intent filter
+            self.assertEqual(
+                summarize(
+                    recognize(
+                        "lamp", graph, examples_path, intent_filter="Weather".__eq__
+                    )
+                ),
+                [("Weather", "damp", 0.75)],
+            )
+
+    def test_sqlite_retrain(self):
+        """Matches are not reused after an examples database is retrained."""
+        turn_on_graph = intents_to_graph(
+            parse_ini(
+                """
+        [TurnOn]
+        turn on the light
+        """
+            )
+        )
+
+        turn_off_graph = intents_to_graph(
+            parse_ini(
+                """
+        [TurnOff]
+        turn off the light
+        """
+            )
+        )
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            examples_path = os.path.join(temp_dir, "examples.db")
+            examples_to_sqlite(train_iter(turn_on_graph), examples_path)
+            self.assertEqual(
+                summarize(recognize("turn on the light", turn_on_graph, examples_path)),
+                [("TurnOn", "turn on the light", 1.0)],
+            )
+
+            # Retrained in place
+            examples_to_sqlite(train_iter(turn_off_graph), examples_path)
+            self.assertEqual(
+                summarize(
+                    recognize("turn on the light", turn_off_graph, examples_path)
+                ),
+                [("TurnOff", "turn off the light", ANY)],
+            )
+
+            # Replaced by a database trained elsewhere
+            other_path = os.path.join(temp_dir, "other.db")
+            examples_to_sqlite(train_iter(turn_on_graph), other_path)
+            os.replace(other_path, examples_path)
+            self.assertEqual(
+                summarize(recognize("turn on the light", turn_on_graph, examples_path)),
+                [("TurnOn", "turn on the light", 1.0)],
+            )
+
+    def test_sqlite_old_version(self):
+        """Examples databases from older releases must be retrained."""
+        graph = intents_to_graph(
+            parse_ini(
+                """
+        [TurnOn]
+        turn on the light
+        """
+            )
+        )
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # Layout of older releases (JSON paths, PRAGMA user_version = 0)
+            examples_path = os.path.join(temp_dir, "examples.db")
+            conn = sqlite3.connect(examples_path)
+            conn.execute("CREATE TABLE intents (sentence text, path text)")
+            conn.execute(
+                "INSERT INTO intents VALUES (?, ?)", ("turn on the light", "[0, 1, 2]")
+            )
+            conn.commit()
+            conn.close()
+
+            with self.assertRaises(ValueError):
+                recognize("turn on the light", graph, examples_path)
+
+    def test_examples_to_sqlite_scaling(self):
+        """Writing examples takes time linear in their number."""
+
+        def write_seconds(num_examples, temp_dir):
+            # Every sentence is generated twice
+            examples = [
+                ("TestIntent", f"sentence {index // 2}", [0, index])
+                for index in range(num_examples)
+            ]
+
+            seconds = []
+            for run in range(3):
+                examples_path = os.path.join(temp_dir, f"{num_examples}_{run}.db")
+                start_time = time.perf_counter()
+                examples_to_sqlite(examples, examples_path)
+                seconds.append(time.perf_counter() - start_time)
+
+            conn = sqlite3.connect(examples_path)
+            (num_rows,) = conn.execute("SELECT COUNT(*) FROM intents").fetchone()
+            conn.close()
+            self.assertEqual(num_rows, num_examples // 2)
+
+            return min(seconds)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            small_seconds = write_seconds(2000, temp_dir)
+            large_seconds = write_seconds(16000, temp_dir)
+
+        # 8x the examples: about 8x the time if linear, 64x if quadratic
+        self.assertLess(large_seconds, 24 * small_seconds)
+
 
 # # -----------------------------------------------------------------------------
 
 
-def zero_times(recognitions):
-    """Set times to zero so they can be easily compared in assertions"""
-    for recognition in recognitions:
-        recognition.recognize_seconds = 0
+def entities_by_name(recognition):
+    """Map entity names to entities of a recognition"""
+    return {e.entity: e for e in recognition.entities}
+
 
-    return recognitions
+def summarize(recognitions):
+    """Reduce recognitions to (intent, text, confidence) for comparisons"""
+    return [(r.intent.name, r.text, r.intent.confidence) for r in recognitions]